@@ -1,140 +1,446 @@
 import os
-import requests
-import json
 import asyncio
+import functools
+import logging
+import logging.handlers
+import queue
+import weakref
+import aiohttp
 import asyncpg
-import uuid # For generating random usernames
+import orjson
+from aiolimiter import AsyncLimiter
+import re
+import time
+from secrets import token_hex # For generating random usernames
+from selectolax.parser import HTMLParser
+from tenacity import AsyncRetrying, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_exponential
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram import Update, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden, TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, ContextTypes, CallbackQueryHandler
 
 # --- Configuration ---
 # Get your Telegram Bot Token from environment variables (important for Railway deployment)
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
-# Mail.tm API base URL
+# Log verbosity (optional): DEBUG, INFO (default), WARNING, ...
+# Use WARNING in production to drop the routine per-request records.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Webhook mode (optional): when PUBLIC_URL is set (e.g. https://my-bot.up.railway.app),
+# Telegram pushes updates to PUBLIC_URL/<token> on PORT instead of the bot long-polling.
+# On Railway, the service's RAILWAY_PUBLIC_DOMAIN is used when PUBLIC_URL is not set.
+RAILWAY_PUBLIC_DOMAIN = os.getenv("RAILWAY_PUBLIC_DOMAIN")
+PUBLIC_URL = os.getenv("PUBLIC_URL") or (f"https://{RAILWAY_PUBLIC_DOMAIN}" if RAILWAY_PUBLIC_DOMAIN else None)
+PORT = int(os.getenv("PORT", 8443))
+
+# Concurrency limits for update handlers: a single chat may run at most PER_CHAT_CONCURRENCY
+# handlers at once, and the whole bot at most GLOBAL_CONCURRENCY (fair share of DB/HTTP pools).
+# Keep PER_CHAT_CONCURRENCY at 1: a chat's updates then run one at a time, in order, so a
+# double-tapped "Yes, generate new" or two quick /generate can't create two accounts at once.
+PER_CHAT_CONCURRENCY = 1
+GLOBAL_CONCURRENCY = 32
+
+# /inbox replies stay below Telegram's 4096-character message limit
+INBOX_TEXT_LIMIT = 4000
+
+# Message bodies longer than MAX_BODY_LENGTH are cut to MAX_BODY characters before display,
+# leaving room for the subject/sender header within Telegram's message limit
+MAX_BODY_LENGTH = 4000
+MAX_BODY = 3900
+
+# PostgreSQL pool sizing (optional, override per deployment):
+#   PG_MIN - connections kept open while idle (default 1)
+#   PG_MAX - upper bound on concurrent connections (default 20)
+PG_MIN = int(os.getenv("PG_MIN", 1))
+PG_MAX = int(os.getenv("PG_MAX", 20))
+
+# Mail.tm API base URL and endpoint paths (relative to the shared session's base_url)
 MAILTM_API_URL = "https://api.mail.tm"
+DOMAINS_PATH = "/domains"
+ACCOUNTS_PATH = "/accounts"
+TOKEN_PATH = "/token"
+ACCOUNT_PATH = "/accounts/{account_id}"
+MESSAGES_PATH = "/accounts/{account_id}/messages"
+MESSAGE_PATH = "/accounts/{account_id}/messages/{message_id}"
+
+# Password of every account we create: Mail.tm requires one, and it lets us renew a rejected token
+ACCOUNT_PASSWORD = "temp_password"
+
+# How long (in seconds) the Mail.tm domain list is reused before refetching
+DOMAINS_CACHE_TTL = 6 * 60 * 60
+
+# How long (in seconds) a user's email row is served from memory before rereading the DB,
+# and how many chats' rows are kept at most
+USER_CACHE_TTL = 30
+USER_CACHE_MAX = 10_000
+
+# How long (in seconds) an inbox listing is reused before asking Mail.tm again
+INBOX_CACHE_TTL = 5
+
+# Attempts per Mail.tm request (first try included) before a transient failure is reported
+MAILTM_RETRY_ATTEMPTS = 3
+
+# Background inbox polling: every INBOX_POLL_INTERVAL seconds all active inboxes are checked and
+# new messages are pushed to their users. Mail.tm allows 8 requests per second per IP, so background
+# fetches (poller and stream catch-ups) are limited to INBOX_POLL_RATE per second, leaving the rest
+# for interactive commands; at most INBOX_POLL_CONCURRENCY of them are in flight at once.
+INBOX_POLL_INTERVAL = 15
+INBOX_POLL_RATE = 5
+INBOX_POLL_CONCURRENCY = 8
+# Only addresses created within INBOX_POLL_MAX_AGE seconds are polled, newest first, and no more per
+# run than the rate limit fits into one interval, so a run never overruns the next one. Older
+# addresses still work with /inbox.
+INBOX_POLL_MAX_AGE = 3 * 24 * 60 * 60
+INBOX_POLL_MAX_CHATS = INBOX_POLL_RATE * INBOX_POLL_INTERVAL
+
+# Pushed notifications are paced to PUSH_RATE_PER_CHAT messages per second per chat, Telegram's
+# guideline for a single chat; the process-wide ~30 messages/second cap is left to AIORateLimiter.
+PUSH_RATE_PER_CHAT = 1
+
+# Mail.tm's Mercure hub streams new-message events per account (Server-Sent Events).
+# A stream idle for MERCURE_IDLE_TIMEOUT seconds is reopened, so a silently dropped
+# connection delays mail by at most that long.
+MERCURE_URL = "https://mercure.mail.tm/.well-known/mercure"
+MERCURE_IDLE_TIMEOUT = 300
+# At most this many streams are open; they go to the most recently created addresses and
+# every other address is covered by the background poller instead
+MERCURE_MAX_STREAMS = 200
+
+# --- Logging ---
+logger = logging.getLogger("tempmail")
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Routes all log records through a queue so handlers never block on stdout writes."""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.setLevel(LOG_LEVEL)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    # httpx logs every Bot API request at INFO, which is just noise for us
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    # The listener thread does the actual (blocking) writes
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
 
 # --- Database Connection Pool ---
 # Global variable for the connection pool
 db_pool = None
 
+# Guards pool creation so concurrent init_db_pool() calls can't create two pools
+_db_init_lock = asyncio.Lock()
+# Startup connection attempts before giving up (waits 1s, 2s, 4s, 8s in between)
+DB_CONNECT_ATTEMPTS = 5
+
+# --- HTTP Session ---
+# Shared aiohttp session for all Mail.tm calls (created on startup, closed on shutdown)
+http_session: aiohttp.ClientSession | None = None
+# Separate session for the long-lived Mercure streams, so they never hold API connection slots
+mercure_session: aiohttp.ClientSession | None = None
+
+# --- Domains Cache ---
+# (fetched_at, domains) from the last successful /domains call; domains change rarely
+_domains_cache: tuple[float, list[str]] | None = None
+_domains_lock = asyncio.Lock()
+
+# --- Inbox Cache ---
+# account_id -> (fetched_at, ETag or None, messages); absorbs rapid repeated /inbox presses
+_inbox_cache: dict[str, tuple[float, str | None, list[dict]]] = {}
+
+# --- User Email Cache ---
+# chat_id -> (email info or None, expires_at); write-through, kept in sync by the DB helpers.
+# Kept in expiry order (every entry has the same TTL), so expired entries are trimmed from the front.
+_user_cache: dict[int, tuple[dict | asyncpg.Record | None, float]] = {}
+# Per-chat locks serialize cache misses and writes, so concurrent callbacks share one SELECT
+# and a slow read can't overwrite a newer write. Dropped automatically when unused.
+_user_cache_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+# --- Handler Concurrency Limits ---
+# Per-chat semaphores disappear on their own once no handler for that chat holds a reference
+_chat_semaphores: weakref.WeakValueDictionary[int, asyncio.Semaphore] = weakref.WeakValueDictionary()
+_global_semaphore = asyncio.Semaphore(GLOBAL_CONCURRENCY)
+
+# --- Inbox Poller State ---
+# chat_id -> (account_id, IDs of messages already in the inbox or already pushed to the user)
+_seen_messages: dict[int, tuple[str, set[str]]] = {}
+# Shared by every background job, so overlapping runs still respect one Mail.tm request budget
+_poll_semaphore = asyncio.Semaphore(INBOX_POLL_CONCURRENCY)
+_poll_rate_limiter = AsyncLimiter(INBOX_POLL_RATE, 1)
+# chat_id -> limiter pacing that chat's pushed notifications
+_push_limiters: dict[int, AsyncLimiter] = {}
+# chat_id -> task streaming that chat's Mercure events. The poller skips chats with an open stream
+# (a baseline exists) and those whose watcher is still on its first connect and catch-up.
+_mail_watchers: dict[int, asyncio.Task] = {}
+_live_streams: set[int] = set()
+_pending_streams: set[int] = set()
+
 # --- Database Functions ---
 
+# Hot-path SQL, kept as constants so every call hits asyncpg's per-connection statement cache
+# created_at only moves when the address changes, and identical rows aren't rewritten at all
+# (no new row version / WAL record for repeated stores of the same account).
+SQL_UPSERT_USER_EMAIL = '''
+    INSERT INTO users_temp_emails (chat_id, address, account_id, token)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (chat_id) DO UPDATE
+    SET address = EXCLUDED.address,
+        account_id = EXCLUDED.account_id,
+        token = EXCLUDED.token,
+        created_at = CASE
+            WHEN users_temp_emails.address <> EXCLUDED.address THEN CURRENT_TIMESTAMP
+            ELSE users_temp_emails.created_at
+        END
+    WHERE (users_temp_emails.address, users_temp_emails.account_id, users_temp_emails.token)
+        IS DISTINCT FROM (EXCLUDED.address, EXCLUDED.account_id, EXCLUDED.token)
+    RETURNING address, account_id AS id, token
+'''
+# account_id is aliased to "id" so the Record can be used exactly like create_account()'s dict
+SQL_GET_USER_EMAIL = '''
+    SELECT address, account_id AS id, token FROM users_temp_emails WHERE chat_id = $1
+'''
+SQL_GET_POLLED_USER_EMAILS = '''
+    SELECT chat_id, address, account_id AS id, token FROM users_temp_emails
+    WHERE created_at > LOCALTIMESTAMP - make_interval(secs => $1)
+    ORDER BY created_at DESC
+'''
+SQL_GET_RECENT_USER_EMAILS = '''
+    SELECT chat_id, address, account_id AS id, token FROM users_temp_emails
+    ORDER BY created_at DESC NULLS LAST LIMIT $1
+'''
+SQL_DELETE_USER_EMAIL = '''
+    DELETE FROM users_temp_emails WHERE chat_id = $1
+'''
+# Like the delete below, only touches the row if it still holds that account
+SQL_UPDATE_USER_TOKEN = '''
+    UPDATE users_temp_emails SET token = $3 WHERE chat_id = $1 AND account_id = $2
+'''
+# Only removes the row if it still holds that account, so a concurrent /generate isn't undone
+SQL_DELETE_USER_ACCOUNT = '''
+    DELETE FROM users_temp_emails WHERE chat_id = $1 AND account_id = $2
+'''
+
+async def init_connection(conn: asyncpg.Connection):
+    """Warms each new pool connection's statement cache with the lookup query."""
+    try:
+        # Running the read-only SELECT once parses, plans and caches it before the first user request.
+        # Write statements are cached on their first real use.
+        await conn.fetchrow(SQL_GET_USER_EMAIL, 0)
+    except asyncpg.UndefinedTableError:
+        pass # First start: create_table() hasn't run yet
+
 async def init_db_pool():
     """Initializes the PostgreSQL connection pool and creates the table."""
     global db_pool
-    if db_pool is None:
+    async with _db_init_lock:
+        if db_pool is not None:
+            return
         try:
-            # Railway automatically injects DATABASE_URL from the added PostgreSQL service
-            db_pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"))
-            print("PostgreSQL connection pool created successfully.")
+            for attempt in range(DB_CONNECT_ATTEMPTS):
+                try:
+                    # Railway automatically injects DATABASE_URL from the added PostgreSQL service
+                    db_pool = await asyncpg.create_pool(
+                        os.getenv("DATABASE_URL"),
+                        min_size=PG_MIN,
+                        max_size=PG_MAX,
+                        max_inactive_connection_lifetime=60, # Give idle connections back to the server after a minute
+                        command_timeout=10,
+                        statement_cache_size=1024,
+                        server_settings={"application_name": "temp-mail-bot"}, # Identifies our sessions in pg_stat_activity
+                        init=init_connection
+                    )
+                    break
+                except (OSError, asyncio.TimeoutError, asyncpg.CannotConnectNowError) as e:
+                    # Database not reachable (yet), e.g. still starting after a redeploy
+                    if attempt == DB_CONNECT_ATTEMPTS - 1:
+                        raise
+                    delay = 2 ** attempt
+                    logger.warning("PostgreSQL not reachable (%s), retrying in %ss...", e, delay)
+                    await asyncio.sleep(delay)
+            logger.info("PostgreSQL connection pool created successfully.")
             await create_table() # Ensure the table exists
         except Exception as e:
-            print(f"Error creating PostgreSQL connection pool: {e}")
+            logger.error("Error creating PostgreSQL connection pool: %s", e)
             # Raising the exception here will stop the bot,
             # which is good if the database is essential.
             raise
 
 async def create_table():
     """Creates the users_temp_emails table if it doesn't exist."""
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users_temp_emails (
-                chat_id BIGINT PRIMARY KEY,
-                address TEXT NOT NULL,
-                account_id TEXT NOT NULL,
-                token TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        print("Table 'users_temp_emails' checked/created.")
-
-async def store_user_email(chat_id: int, email_data: dict):
-    """Stores or updates a user's temporary email information in the database."""
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO users_temp_emails (chat_id, address, account_id, token)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (chat_id) DO UPDATE
-            SET address = EXCLUDED.address,
-                account_id = EXCLUDED.account_id,
-                token = EXCLUDED.token,
-                created_at = CURRENT_TIMESTAMP
-        ''', chat_id, email_data["address"], email_data["id"], email_data["token"])
-    print(f"Stored/updated email for chat_id: {chat_id}")
-
-async def get_user_email(chat_id: int) -> dict | None:
-    """Retrieves a user's temporary email information from the database."""
-    async with db_pool.acquire() as conn:
-        record = await conn.fetchrow('''
-            SELECT address, account_id, token FROM users_temp_emails WHERE chat_id = $1
-        ''', chat_id)
-        if record:
-            return {
-                "address": record["address"],
-                "id": record["account_id"],
-                "token": record["token"]
-            }
-        return None
+    # A catalog lookup is cheaper than sending the DDL on every startup once the table exists
+    if await db_pool.fetchval("SELECT to_regclass('users_temp_emails')") is not None:
+        logger.debug("Table 'users_temp_emails' already exists.")
+        return
+    await db_pool.execute('''
+        CREATE TABLE IF NOT EXISTS users_temp_emails (
+            chat_id BIGINT PRIMARY KEY,
+            address TEXT NOT NULL,
+            account_id TEXT NOT NULL,
+            token TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    logger.debug("Table 'users_temp_emails' checked/created.")
+
+def _user_cache_lock(chat_id: int) -> asyncio.Lock:
+    """Returns the lock guarding a chat's cache entry, creating it if needed."""
+    lock = _user_cache_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_cache_locks[chat_id] = lock
+    return lock
+
+def _cache_user_email(chat_id: int, info: dict | asyncpg.Record | None):
+    """Caches a chat's row (or its absence) and evicts expired or excess entries."""
+    now = time.monotonic()
+    _user_cache.pop(chat_id, None) # Re-insert at the end to keep the dict in expiry order
+    _user_cache[chat_id] = (info, now + USER_CACHE_TTL)
+    while len(_user_cache) > 1:
+        oldest_chat_id, (_, expires_at) = next(iter(_user_cache.items()))
+        if expires_at > now and len(_user_cache) <= USER_CACHE_MAX:
+            break
+        del _user_cache[oldest_chat_id]
+
+async def store_user_email(chat_id: int, email_data: dict) -> dict | asyncpg.Record:
+    """Stores or updates a user's temporary email information and returns the stored row."""
+    async with _user_cache_lock(chat_id):
+        # RETURNING hands back the stored row in the same round-trip, so no follow-up SELECT is needed.
+        # It yields nothing when the row was already identical, in which case email_data is the row.
+        record = await db_pool.fetchrow(SQL_UPSERT_USER_EMAIL, chat_id, email_data["address"], email_data["id"], email_data["token"])
+        stored = record or email_data
+        _cache_user_email(chat_id, stored)
+    logger.debug("Stored/updated email for chat_id: %s", chat_id)
+    return stored
+
+async def get_user_email(chat_id: int) -> dict | asyncpg.Record | None:
+    """Retrieves a user's temporary email information, from the cache or the database."""
+    cached = _user_cache.get(chat_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    async with _user_cache_lock(chat_id):
+        # Another task may have loaded (or written) the entry while we waited for the lock
+        cached = _user_cache.get(chat_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        # The Record already supports info["address"] / ["id"] / ["token"], no need to copy it into a dict
+        record = await db_pool.fetchrow(SQL_GET_USER_EMAIL, chat_id)
+        _cache_user_email(chat_id, record)
+        return record
 
 async def delete_user_email_from_db(chat_id: int):
     """Deletes a user's temporary email information from the database."""
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            DELETE FROM users_temp_emails WHERE chat_id = $1
-        ''', chat_id)
-    print(f"Deleted email from DB for chat_id: {chat_id}")
+    async with _user_cache_lock(chat_id):
+        await db_pool.execute(SQL_DELETE_USER_EMAIL, chat_id)
+        _user_cache.pop(chat_id, None)
+    logger.debug("Deleted email from DB for chat_id: %s", chat_id)
+
+async def update_user_token(chat_id: int, account_id: str, token: str):
+    """Stores a renewed Mail.tm token, if the chat still uses that account."""
+    async with _user_cache_lock(chat_id):
+        await db_pool.execute(SQL_UPDATE_USER_TOKEN, chat_id, account_id, token)
+        _user_cache.pop(chat_id, None)
+    logger.debug("Renewed token for chat_id: %s", chat_id)
+
+async def delete_user_account_from_db(chat_id: int, account_id: str) -> bool:
+    """Deletes a user's row only if it still refers to account_id; True if a row was deleted."""
+    async with _user_cache_lock(chat_id):
+        status = await db_pool.execute(SQL_DELETE_USER_ACCOUNT, chat_id, account_id)
+        deleted = status == "DELETE 1"
+        if deleted:
+            _user_cache.pop(chat_id, None)
+    return deleted
 
 # --- Mail.tm API Functions ---
 
-async def get_domains() -> list[str]:
-    """Fetches available Mail.tm domains."""
-    try:
-        response = requests.get(f"{MAILTM_API_URL}/domains", timeout=10) # Added timeout
-        response.raise_for_status()
+class AccountGoneError(Exception):
+    """Raised when Mail.tm no longer knows an account (expired or deleted on its side)."""
 
-        if not response.text:
-            print("Mail.tm /domains endpoint returned empty response.")
-            return []
+class TokenRejectedError(Exception):
+    """Raised when Mail.tm rejects an account's token (HTTP 401); a new one may still be issued."""
 
-        data = response.json()
+def _auth(token: str) -> dict[str, str]:
+    """Builds the bearer-token header for an account's requests."""
+    return {"Authorization": "Bearer " + token}
 
-        if isinstance(data, dict) and 'hydra:member' in data:
-            domains_list = data['hydra:member']
-        elif isinstance(data, list): # Fallback if it's directly a list (less common based on logs)
-            domains_list = data
-        else:
-            print(f"Mail.tm /domains endpoint returned unexpected top-level data structure: {data}")
-            return []
+def _is_transient(exc: BaseException) -> bool:
+    """True for failures worth retrying: network errors, timeouts, 429 and 5xx responses."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
 
-        if not isinstance(domains_list, list):
-            print(f"Mail.tm /domains endpoint 'hydra:member' data is not a list: {domains_list}")
-            return []
+# Retry policies for Mail.tm calls; use .copy() per call since a Retrying object keeps per-run state.
+# The last exception is re-raised so each caller's existing error handling still applies.
+# Idempotent requests (GET/DELETE, and POST /token) retry on any transient failure
+RETRY_IDEMPOTENT = AsyncRetrying(
+    stop=stop_after_attempt(MAILTM_RETRY_ATTEMPTS),
+    wait=wait_exponential(multiplier=0.2, max=2),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+# POST /accounts only retries when the connection was never made, so an account is never created twice
+RETRY_CONNECT = RETRY_IDEMPOTENT.copy(retry=retry_if_exception_type(aiohttp.ClientConnectorError))
+
+async def get_domains() -> list[str]:
+    """Returns available Mail.tm domains, served from an in-process cache when fresh."""
+    global _domains_cache
+    if _domains_cache and time.monotonic() - _domains_cache[0] < DOMAINS_CACHE_TTL:
+        return _domains_cache[1]
 
-        if not domains_list:
-            print("Mail.tm /domains endpoint returned an empty list of domains (or hydra:member was empty).")
-            return []
+    async with _domains_lock:
+        # Another task may have refreshed the cache while we waited for the lock
+        if _domains_cache and time.monotonic() - _domains_cache[0] < DOMAINS_CACHE_TTL:
+            return _domains_cache[1]
 
-        return [d["domain"] for d in domains_list if isinstance(d, dict) and "domain" in d]
+        domains = await fetch_domains()
+        if domains: # Never cache a failed/empty fetch
+            _domains_cache = (time.monotonic(), domains)
+        return domains
 
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error fetching domains: {e.response.status_code} - {e.response.text}")
+def invalidate_domains_cache():
+    """Forces the next get_domains() call to refetch from Mail.tm."""
+    global _domains_cache
+    _domains_cache = None
+
+async def fetch_domains() -> list[str]:
+    """Fetches available Mail.tm domains."""
+    response_text = ""
+    try:
+        async for attempt in RETRY_IDEMPOTENT.copy():
+            with attempt:
+                async with http_session.get(DOMAINS_PATH) as response:
+                    response_text = await response.text()
+                    response.raise_for_status()
+
+        data = orjson.loads(response_text)
+        # Normally {"hydra:member": [...]}; a bare list is accepted as a fallback
+        domains = [d["domain"] for d in (data if isinstance(data, list) else data["hydra:member"])]
+        if not domains:
+            logger.warning("Mail.tm /domains endpoint returned an empty list of domains.")
+        return domains
+
+    except aiohttp.ClientResponseError as e:
+        logger.error("HTTP Error fetching domains: %s - %s", e.status, response_text)
         return []
-    except requests.exceptions.ConnectionError as e:
-        print(f"Connection Error fetching domains: {e}")
+    except aiohttp.ClientConnectionError as e:
+        logger.error("Connection Error fetching domains: %s", e)
         return []
-    except requests.exceptions.Timeout as e:
-        print(f"Timeout Error fetching domains: {e}")
+    except asyncio.TimeoutError as e:
+        logger.error("Timeout Error fetching domains: %s", e)
         return []
-    except requests.exceptions.RequestException as e:
-        print(f"Generic Request Error fetching domains: {e}")
+    except aiohttp.ClientError as e:
+        logger.error("Generic Request Error fetching domains: %s", e)
         return []
-    except json.JSONDecodeError as e:
-        print(f"JSON Decode Error fetching domains: {e} - Response text: {response.text}")
+    except orjson.JSONDecodeError as e:
+        logger.error("JSON Decode Error fetching domains: %s - Response text: %s", e, response_text)
+        return []
+    except (KeyError, TypeError) as e:
+        logger.warning("Mail.tm /domains endpoint returned unexpected data structure (%r): %s", e, response_text)
         return []
     except Exception as e:
-        print(f"An unexpected error occurred in get_domains: {e}")
+        logger.exception("An unexpected error occurred in get_domains: %s", e)
         return []
 
 async def create_account(username: str = None, domain: str = None) -> tuple[dict | None, str | None]:
@@ -146,97 +452,243 @@ async def create_account(username: str = None, domain: str = None) -> tuple[dict
         domain = domains[0] # Use the first available domain by default
 
     if not username:
-        username = str(uuid.uuid4()).split('-')[0] # Simple random string
+        username = token_hex(4) # Simple random 8-char hex string
 
     address = f"{username}@{domain}"
-    password = "temp_password" # Password is required by Mail.tm but not used by us
+    password = ACCOUNT_PASSWORD
 
+    response_text = ""
     try:
         # Create account
         payload_create = {"address": address, "password": password}
-        response_create = requests.post(f"{MAILTM_API_URL}/accounts", json=payload_create, timeout=10)
-        response_create.raise_for_status()
-        account_data = response_create.json()
+        async for attempt in RETRY_CONNECT.copy():
+            with attempt:
+                async with http_session.post(ACCOUNTS_PATH, json=payload_create) as response_create:
+                    response_text = await response_create.text()
+                    response_create.raise_for_status()
+        account_data = orjson.loads(response_text)
         
-        # Get authentication token for the new account
+        # Get authentication token for the new account (safe to repeat, it has no side effects)
         payload_token = {"address": account_data["address"], "password": password}
-        response_token = requests.post(f"{MAILTM_API_URL}/token", json=payload_token, timeout=10)
-        response_token.raise_for_status()
-        token_data = response_token.json()
+        async for attempt in RETRY_IDEMPOTENT.copy():
+            with attempt:
+                async with http_session.post(TOKEN_PATH, json=payload_token) as response_token:
+                    response_text = await response_token.text()
+                    response_token.raise_for_status()
+        token_data = orjson.loads(response_text)
 
         return {
             "address": account_data["address"],
             "id": account_data["id"],
             "token": token_data["token"]
         }, None
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error creating account: {e.response.status_code} - {e.response.text}")
-        if e.response.status_code == 422: # Unprocessable Entity, often means address already exists
+    except aiohttp.ClientResponseError as e:
+        logger.error("HTTP Error creating account: %s - %s", e.status, response_text)
+        if e.status == 422: # Unprocessable Entity, often means address already exists
+            invalidate_domains_cache() # The cached domain may no longer be accepted
             return None, f"Could not create address '{address}'. It might already exist or the domain is invalid. Try generating a new one."
-        return None, f"Failed to create temporary email due to API error: {e.response.status_code} - {e.response.text}"
-    except requests.exceptions.RequestException as e:
-        print(f"Generic Request Error creating account: {e}")
+        return None, f"Failed to create temporary email due to API error: {e.status} - {response_text}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Generic Request Error creating account: %s", e)
         return None, f"Failed to create temporary email due to connection issue: {e}"
     except Exception as e:
-        print(f"An unexpected error occurred in create_account: {e}")
+        logger.exception("An unexpected error occurred in create_account: %s", e)
         return None, f"An unexpected error occurred: {e}"
 
-async def get_messages(account_id: str, token: str) -> list[dict]:
-    """Fetches messages for a given temporary email account."""
+async def get_messages(account_id: str, token: str) -> list[dict] | None:
+    """Fetches an account's messages, reusing very recent results (None on failure; raises on 401/404)."""
+    cached = _inbox_cache.get(account_id)
+    if cached and time.monotonic() - cached[0] < INBOX_CACHE_TTL:
+        return cached[2]
+
     try:
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(f"{MAILTM_API_URL}/accounts/{account_id}/messages", headers=headers, timeout=10)
-        response.raise_for_status()
-        messages = response.json()
+        headers = _auth(token)
+        if cached and cached[1]:
+            headers["If-None-Match"] = cached[1] # Let Mail.tm answer 304 if nothing changed
+        async for attempt in RETRY_IDEMPOTENT.copy():
+            with attempt:
+                async with http_session.get(MESSAGES_PATH.format(account_id=account_id), headers=headers) as response:
+                    if response.status == 304 and cached:
+                        _inbox_cache[account_id] = (time.monotonic(), cached[1], cached[2])
+                        return cached[2]
+                    response.raise_for_status()
+                    messages = orjson.loads(await response.read())
+                    etag = response.headers.get("ETag")
+        _inbox_cache[account_id] = (time.monotonic(), etag, messages)
         return messages
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error fetching messages: {e.response.status_code} - {e.response.text}")
-        if e.response.status_code == 404: # Account likely deleted by Mail.tm
-            return [] # Return empty list as if no messages, or handle differently later
-        return []
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching messages: {e}")
-        return []
+    except aiohttp.ClientResponseError as e:
+        if e.status == 404: # Account expired or deleted by Mail.tm
+            _inbox_cache.pop(account_id, None)
+            logger.info("Mail.tm account %s is gone", account_id)
+            raise AccountGoneError(account_id) from e
+        if e.status == 401: # Token rejected; the account itself may be fine
+            raise TokenRejectedError(account_id) from e
+        logger.error("HTTP Error fetching messages: %s - %s", e.status, e.message)
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error fetching messages: %s", e)
+        return None
+    except orjson.JSONDecodeError as e:
+        logger.error("JSON Decode Error fetching messages: %s", e)
+        return None
+
+async def fetch_token(address: str) -> str | None:
+    """Requests a new token for one of our accounts (None on failure, AccountGoneError if login is refused)."""
+    try:
+        async for attempt in RETRY_IDEMPOTENT.copy():
+            with attempt:
+                async with http_session.post(TOKEN_PATH, json={"address": address, "password": ACCOUNT_PASSWORD}) as response:
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())["token"]
+    except aiohttp.ClientResponseError as e:
+        if e.status == 401: # Our own credentials no longer work: the account is gone
+            logger.info("Mail.tm refused login for %s, account is gone", address)
+            raise AccountGoneError(address) from e
+        logger.error("HTTP Error renewing token: %s - %s", e.status, e.message)
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logger.error("Error renewing token: %r", e)
+        return None
+
+async def renew_token(chat_id: int, info: dict | asyncpg.Record) -> str | None:
+    """Gets and stores a new token for the chat's account (None on failure, AccountGoneError if it's gone)."""
+    token = await fetch_token(info["address"])
+    if token:
+        await update_user_token(chat_id, info["id"], token)
+    return token
+
+async def fetch_inbox(chat_id: int, info: dict | asyncpg.Record) -> list[dict] | None:
+    """Like get_messages for the chat's account, renewing a rejected token once before giving up."""
+    try:
+        return await get_messages(info["id"], info["token"])
+    except TokenRejectedError:
+        token = await renew_token(chat_id, info)
+        if token is None:
+            return None
+    try:
+        return await get_messages(info["id"], token)
+    except TokenRejectedError as e: # Even a freshly issued token is refused
+        raise AccountGoneError(info["id"]) from e
 
 async def get_message_content(account_id: str, message_id: str, token: str) -> dict | None:
     """Fetches the content of a specific message."""
     try:
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.get(f"{MAILTM_API_URL}/accounts/{account_id}/messages/{message_id}", headers=headers, timeout=10)
-        response.raise_for_status()
-        message_content = response.json()
+        path = MESSAGE_PATH.format(account_id=account_id, message_id=message_id)
+        async for attempt in RETRY_IDEMPOTENT.copy():
+            with attempt:
+                async with http_session.get(path, headers=_auth(token)) as response:
+                    response.raise_for_status()
+                    message_content = orjson.loads(await response.read())
         return message_content
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching message content: {e}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error fetching message content: %s", e)
         return None
 
 async def delete_account(account_id: str, token: str) -> tuple[bool, str | None]:
     """Deletes a temporary email account from Mail.tm."""
+    _inbox_cache.pop(account_id, None)
     try:
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.delete(f"{MAILTM_API_URL}/accounts/{account_id}", headers=headers, timeout=10)
-        response.raise_for_status()
+        # A retry after a DELETE that did land gets a 404, which is treated as success below
+        async for attempt in RETRY_IDEMPOTENT.copy():
+            with attempt:
+                async with http_session.delete(ACCOUNT_PATH.format(account_id=account_id), headers=_auth(token)) as response:
+                    response.raise_for_status()
         return True, None
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error deleting account: {e.response.status_code} - {e.response.text}")
-        if e.response.status_code == 404:
-            return True, "Account already deleted on Mail.tm's side." # Treat 404 as success if account is gone
-        return False, f"Failed to delete account from Mail.tm: {e.response.status_code} - {e.response.text}"
-    except requests.exceptions.RequestException as e:
-        print(f"Generic Request Error deleting account: {e}")
+    except aiohttp.ClientResponseError as e:
+        if e.status == 404: # Already gone (expired, or an earlier attempt of this DELETE landed): success
+            logger.debug("Mail.tm account %s already deleted", account_id)
+            return True, "Account already deleted on Mail.tm's side."
+        logger.error("HTTP Error deleting account: %s - %s", e.status, e.message)
+        return False, f"Failed to delete account from Mail.tm: {e.status} - {e.message}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Generic Request Error deleting account: %s", e)
         return False, f"Failed to delete account due to connection issue: {e}"
 
+# --- Message Formatting Helpers ---
+
+# Collapses runs of whitespace left behind after stripping HTML tags
+_WS_RE = re.compile(r"\s+")
+
+def _code_safe(text: str) -> str:
+    """Makes text safe to wrap in a Markdown `code` span, which can't contain backticks."""
+    return text.replace('`', "'")
+
+# Case-insensitive tag probes; searching avoids lower()-copying the whole body just to detect HTML
+_HTML_TAG_RE = re.compile(r"<html", re.IGNORECASE)
+_BODY_TAG_RE = re.compile(r"<body", re.IGNORECASE)
+
+# HTML bodies larger than this (in characters) are stripped in a worker thread
+HTML_OFFLOAD_THRESHOLD = 8192
+
+def _strip_html(html: str) -> str:
+    """Extracts the visible text of an HTML document (C-backed selectolax parser)."""
+    tree = HTMLParser(html)
+    tree.strip_tags(["script", "style"]) # Their contents are not meant to be read
+    root = tree.body or tree.root
+    if root is None:
+        return ""
+    return _WS_RE.sub(" ", root.text(separator=" ")).strip() # Remove excessive whitespace
+
+# --- Inline Keyboards ---
+# Static confirmation keyboards, built once and reused for every prompt
+GENERATE_CONFIRM_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton("Yes, generate new", callback_data="confirm_generate"),
+    InlineKeyboardButton("No, keep current", callback_data="cancel_generate")
+]])
+DELETE_CONFIRM_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton("Yes, delete it", callback_data="confirm_delete"),
+    InlineKeyboardButton("No, keep it", callback_data="cancel_delete")
+]])
+
 # --- Telegram Bot Command Handlers ---
 
+def limit_concurrency(handler):
+    """Bounds how many updates a handler processes at once, per chat and overall."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat_id = update.effective_chat.id
+        chat_semaphore = _chat_semaphores.get(chat_id)
+        if chat_semaphore is None:
+            chat_semaphore = asyncio.Semaphore(PER_CHAT_CONCURRENCY)
+            _chat_semaphores[chat_id] = chat_semaphore
+        # Take the chat's slot first so one busy chat can't hold more than its share of global slots
+        async with chat_semaphore, _global_semaphore:
+            await handler(update, context)
+    return wrapper
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message and instructions."""
     await update.message.reply_text(
         "Hello! I'm your Temp Mail Bot. I can generate temporary email addresses for you.\n\n"
         "Use /generate to get a new temporary email address.\n"
         "Use /inbox to check for new messages in your current temporary email's inbox.\n"
+        "New messages are also sent to you here automatically as they arrive.\n"
         "Use /delete to delete your current temporary email address."
     )
 
+async def _rotate_email(bot, chat_id: int, current_email_info: dict | asyncpg.Record | None) -> tuple[dict | None, str | None]:
+    """Creates and stores a new address for the chat, deleting its current one (if any) meanwhile."""
+    # The old account's DELETE doesn't depend on the new account, so it runs alongside the create calls
+    delete_task = None
+    if current_email_info:
+        delete_task = asyncio.create_task(delete_account(current_email_info["id"], current_email_info["token"]))
+    account_info, error = await create_account()
+
+    if delete_task:
+        # We don't care much if it fails, as it might already be gone.
+        deleted, delete_error = await delete_task
+        if not deleted:
+            logger.warning("Could not delete old Mail.tm account for chat_id %s: %s", chat_id, delete_error)
+
+    if account_info:
+        await store_user_email(chat_id, account_info) # UPSERT replaces any old row in place
+        start_mail_watcher(bot, chat_id, account_info["id"])
+    elif current_email_info:
+        stop_mail_watcher(chat_id)
+        await delete_user_email_from_db(chat_id) # Old account is gone, don't leave a stale row behind
+    return account_info, error
+
+@limit_concurrency
 async def generate_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generates a new temporary email address for the user."""
     chat_id = update.effective_chat.id
@@ -244,24 +696,24 @@ async def generate_email(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     current_email_info = await get_user_email(chat_id)
 
     if current_email_info:
-        keyboard = [[
-            InlineKeyboardButton("Yes, generate new", callback_data="confirm_generate"),
-            InlineKeyboardButton("No, keep current", callback_data="cancel_generate")
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
             f"You already have an active temporary email: `{current_email_info['address']}`. "
             "Generating a new one will delete the old one. Are you sure you want to proceed?",
             parse_mode="Markdown",
-            reply_markup=reply_markup
+            reply_markup=GENERATE_CONFIRM_MARKUP
         )
         return
 
-    await update.message.reply_text("Generating a new temporary email address, please wait...")
-    
-    account_info, error = await create_account()
+    # Start the Mail.tm calls first so their latency overlaps the "please wait" reply
+    rotate_task = asyncio.create_task(_rotate_email(context.bot, chat_id, None))
+    try:
+        await update.message.reply_text("Generating a new temporary email address, please wait...")
+    except TelegramError as e:
+        logger.warning("Could not send progress message to chat_id %s: %s", chat_id, e) # The result is still sent below
+    finally:
+        # Always wait for the account, so this chat's slot isn't freed while it is still being created
+        account_info, error = await rotate_task
     if account_info:
-        await store_user_email(chat_id, account_info)
         await update.message.reply_text(
             f"Your new temporary email address is:\n`{account_info['address']}`\n\n"
             "Use /inbox to check for messages."
@@ -271,6 +723,7 @@ async def generate_email(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         await update.message.reply_text(f"Sorry, I couldn't generate a temporary email address at this time. {error}")
 
+@limit_concurrency
 async def inbox(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Checks the inbox of the current temporary email address."""
     chat_id = update.effective_chat.id
@@ -281,14 +734,21 @@ async def inbox(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("You don't have an active temporary email address. Use /generate to get one.")
         return
 
-    account_id = current_email_info["id"]
-    token = current_email_info["token"]
-    
     await update.message.reply_text("Checking your inbox, please wait...")
     
-    messages = await get_messages(account_id, token)
+    try:
+        messages = await fetch_inbox(chat_id, current_email_info)
+    except AccountGoneError:
+        await _forget_account(chat_id, current_email_info["id"])
+        await update.message.reply_text(
+            "Your temporary email address no longer exists on Mail.tm (it has probably expired). "
+            "Use /generate to get a new one."
+        )
+        return
 
-    if messages:
+    if messages is None:
+        await update.message.reply_text("Could not check your inbox right now. Please try again in a moment.")
+    elif messages:
         # Filter out messages that might have an invalid ID or structure, though unlikely
         valid_messages = [msg for msg in messages if msg.get('id')]
         
@@ -296,25 +756,43 @@ async def inbox(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text("Your inbox is empty or messages could not be parsed.")
             return
 
+        # One reply for the whole inbox: a summary entry and a button per message
+        text = f"**Your inbox ({len(valid_messages)} messages)**"
+        keyboard = []
+        not_listed = 0
         for msg in valid_messages:
-            subject = msg.get('subject', 'No Subject')
-            from_address = msg.get('from', {}).get('address', 'Unknown Sender')
+            subject = msg.get('subject') or 'No Subject'
+            from_address = (msg.get('from') or {}).get('address') or 'Unknown Sender'
             msg_id = msg.get('id')
+            # The list response already carries a short preview, so no per-message fetch is needed
+            intro = _code_safe(msg.get('intro') or '')
             
-            keyboard = [[InlineKeyboardButton(f"Subject: {subject} (From: {from_address})", callback_data=f"view_msg_{msg_id}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            keyboard.append([InlineKeyboardButton(f"Subject: {subject} (From: {from_address})", callback_data=f"view_msg_{msg_id}")])
             
-            await update.message.reply_text(
-                f"**New Message**\n"
-                f"• From: `{from_address}`\n"
-                f"  Subject: `{subject}`",
-                parse_mode="Markdown",
-                reply_markup=reply_markup
+            # One stray backtick would make Telegram reject the whole reply, so every field is sanitized
+            entry = (
+                f"\n\n• From: `{_code_safe(from_address)}`\n"
+                f"  Subject: `{_code_safe(subject)}`"
+                + (f"\n  Preview: `{intro}`" if intro else "")
             )
+            # Every message keeps its button even once the text summary is full
+            if not_listed or len(text) + len(entry) > INBOX_TEXT_LIMIT:
+                not_listed += 1
+            else:
+                text += entry
+        if not_listed:
+            text += f"\n\n... and {not_listed} more, see the buttons below."
+
+        await update.message.reply_text(
+            text,
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
         
     else:
         await update.message.reply_text("Your inbox is empty.")
 
+@limit_concurrency
 async def delete_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Deletes the current temporary email address."""
     chat_id = update.effective_chat.id
@@ -325,151 +803,396 @@ async def delete_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text("You don't have an active temporary email address to delete.")
         return
 
-    keyboard = [[
-        InlineKeyboardButton("Yes, delete it", callback_data="confirm_delete"),
-        InlineKeyboardButton("No, keep it", callback_data="cancel_delete")
-    ]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         f"Are you sure you want to delete your current temporary email address: `{current_email_info['address']}`?",
         parse_mode="Markdown",
-        reply_markup=reply_markup
+        reply_markup=DELETE_CONFIRM_MARKUP
     )
 
+# --- Callback Query Handlers ---
+# Each handler receives the callback query, the chat_id and the argument encoded after the
+# action prefix in callback_data (empty for fixed actions like "confirm_delete").
+
+async def _confirm_delete(query: CallbackQuery, chat_id: int, arg: str) -> None:
+    """Deletes the user's temporary email after they confirmed."""
+    current_email_info = await get_user_email(chat_id)
+    if not current_email_info:
+        await query.edit_message_text("No active email to delete or session expired.")
+        return
+
+    account_id = current_email_info["id"]
+    token = current_email_info["token"]
+    
+    # The DB row doesn't depend on Mail.tm's answer, so both deletions run at the same time
+    mailtm_task = asyncio.create_task(delete_account(account_id, token))
+    db_task = asyncio.create_task(delete_user_email_from_db(chat_id))
+    stop_mail_watcher(chat_id)
+    (success, error), _ = await asyncio.gather(mailtm_task, db_task)
+    if success:
+        await query.edit_message_text("Your temporary email address has been deleted successfully.")
+    else:
+        # The DB row is gone either way, so the bot no longer knows this address
+        await query.edit_message_text(
+            "Your temporary email address has been removed from the bot, but Mail.tm could not "
+            f"be told to delete it; it will expire on Mail.tm's side. {error}"
+        )
+
+async def _cancel_delete(query: CallbackQuery, chat_id: int, arg: str) -> None:
+    """Keeps the user's temporary email."""
+    await query.edit_message_text("Deletion cancelled. Your temporary email address remains active.")
+
+async def _confirm_generate(query: CallbackQuery, chat_id: int, arg: str) -> None:
+    """Replaces the user's temporary email with a newly generated one."""
+    current_email_info = await get_user_email(chat_id)
+    # The Mail.tm calls (old account's delete, new account's create) overlap the "please wait" edit
+    rotate_task = asyncio.create_task(_rotate_email(query.get_bot(), chat_id, current_email_info))
+    try:
+        await query.edit_message_text("Generating a new temporary email address, please wait...")
+    except TelegramError as e:
+        logger.warning("Could not send progress message to chat_id %s: %s", chat_id, e) # The result is still sent below
+    finally:
+        # Always wait for the rotation, so this chat's slot isn't freed while it is still running
+        account_info, error = await rotate_task
+    if account_info:
+        await query.edit_message_text(
+            f"Your new temporary email address is:\n`{account_info['address']}`\n\n"
+            "Use /inbox to check for messages."
+            "Remember, this is temporary and emails are usually deleted by Mail.tm after some time.",
+            parse_mode="Markdown"
+        )
+    else:
+        await query.edit_message_text(f"Sorry, I couldn't generate a temporary email address at this time. {error}")
+
+async def _cancel_generate(query: CallbackQuery, chat_id: int, arg: str) -> None:
+    """Keeps the current email instead of generating a new one."""
+    await query.edit_message_text("New email generation cancelled. Your current email remains active.")
+
+async def _view_msg(query: CallbackQuery, chat_id: int, message_id: str) -> None:
+    """Shows the full content of a message from the user's inbox."""
+    current_email_info = await get_user_email(chat_id)
+    if not current_email_info:
+        await query.edit_message_text("Session expired or no active email. Please generate a new email.")
+        return
+    
+    account_id = current_email_info["id"]
+    token = current_email_info["token"]
+
+    message_content = await get_message_content(account_id, message_id, token)
+    if message_content:
+        subject = message_content.get('subject', 'No Subject')
+        from_address = message_content.get('from', {}).get('address', 'Unknown Sender')
+        text_body = message_content.get('text', message_content.get('html', 'No content available'))
+        
+        # Simple HTML stripping if needed, for better display of HTML content (needs the whole document)
+        if _HTML_TAG_RE.search(text_body) and _BODY_TAG_RE.search(text_body):
+            if len(text_body) > HTML_OFFLOAD_THRESHOLD:
+                # Keep the event loop free for other users while a big email is parsed
+                text_body = await asyncio.to_thread(_strip_html, text_body)
+            else:
+                text_body = _strip_html(text_body)
+
+        # Limit message length to avoid Telegram API limits; cut before strip() so a huge body
+        # is never scanned or copied beyond what is displayed
+        if len(text_body) > MAX_BODY_LENGTH:
+            text_body = text_body[:MAX_BODY].strip() + "\n\n... (Message truncated)"
+        else:
+            text_body = text_body.strip()
+
+        await query.edit_message_text(
+            f"**Subject:** `{_code_safe(subject)}`\n"
+            f"**From:** `{_code_safe(from_address)}`\n\n"
+            f"**Content:**\n```\n{text_body}\n```",
+            parse_mode="Markdown"
+        )
+    else:
+        await query.edit_message_text("Could not retrieve message content. It might have expired or been deleted by Mail.tm.")
+
+# callback_data values handled as-is
+_CALLBACK_HANDLERS = {
+    "confirm_delete": _confirm_delete,
+    "cancel_delete": _cancel_delete,
+    "confirm_generate": _confirm_generate,
+    "cancel_generate": _cancel_generate,
+}
+# callback_data of the form "<prefix>_<arg>", e.g. "view_msg_<message id>"
+_CALLBACK_PREFIX_HANDLERS = {
+    "view_msg": _view_msg,
+}
+
+@limit_concurrency
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles inline keyboard button presses."""
+    """Handles inline keyboard button presses by dispatching on callback_data."""
     query = update.callback_query
     chat_id = query.message.chat_id
     await query.answer() # Acknowledge the callback query immediately
 
-    if query.data == "confirm_delete":
-        current_email_info = await get_user_email(chat_id)
-        if not current_email_info:
-            await query.edit_message_text("No active email to delete or session expired.")
-            return
+    arg = ""
+    handler = _CALLBACK_HANDLERS.get(query.data)
+    if handler is None:
+        prefix, _, arg = query.data.rpartition("_")
+        handler = _CALLBACK_PREFIX_HANDLERS.get(prefix)
+    if handler is None:
+        return # Unknown or stale button
 
-        account_id = current_email_info["id"]
-        token = current_email_info["token"]
-        
-        success, error = await delete_account(account_id, token)
-        if success:
-            await delete_user_email_from_db(chat_id)
-            await query.edit_message_text("Your temporary email address has been deleted successfully.")
-        else:
-            await query.edit_message_text(f"Failed to delete your temporary email address from Mail.tm. {error}")
-    
-    elif query.data == "cancel_delete":
-        await query.edit_message_text("Deletion cancelled. Your temporary email address remains active.")
-
-    elif query.data == "confirm_generate":
-        # Delete old email from Mail.tm first, if exists and still valid
-        current_email_info = await get_user_email(chat_id)
-        if current_email_info:
-            account_id = current_email_info["id"]
-            token = current_email_info["token"]
-            # Attempt to delete from Mail.tm. We don't care much if it fails, as it might already be gone.
-            await delete_account(account_id, token) 
-            await delete_user_email_from_db(chat_id) # Always remove from our DB
-            
-        # Then generate new
-        await query.edit_message_text("Generating a new temporary email address, please wait...")
-        account_info, error = await create_account()
-        if account_info:
-            await store_user_email(chat_id, account_info)
-            await query.edit_message_text(
-                f"Your new temporary email address is:\n`{account_info['address']}`\n\n"
-                "Use /inbox to check for messages."
-                "Remember, this is temporary and emails are usually deleted by Mail.tm after some time.",
-                parse_mode="Markdown"
-            )
-        else:
-            await query.edit_message_text(f"Sorry, I couldn't generate a temporary email address at this time. {error}")
+    await handler(query, chat_id, arg)
+
+# --- Background Jobs ---
+
+async def _forget_account(chat_id: int, account_id: str) -> None:
+    """Deletes a chat's address that is gone or unreachable, so it is neither polled nor streamed again."""
+    if not await delete_user_account_from_db(chat_id, account_id):
+        return # The chat already moved on to another address
+    _seen_messages.pop(chat_id, None)
+    _push_limiters.pop(chat_id, None)
+    stop_mail_watcher(chat_id) # Last: this may cancel the very task running this call
 
-    elif query.data == "cancel_generate":
-        await query.edit_message_text("New email generation cancelled. Your current email remains active.")
+def _baseline(chat_id: int, account_id: str) -> set[str] | None:
+    """Returns the seen message IDs recorded for the chat's current account, None before its baseline."""
+    seen = _seen_messages.get(chat_id)
+    return seen[1] if seen and seen[0] == account_id else None
 
-    elif query.data.startswith("view_msg_"):
-        message_id = query.data.split("_")[2]
-        current_email_info = await get_user_email(chat_id)
-        if not current_email_info:
-            await query.edit_message_text("Session expired or no active email. Please generate a new email.")
+async def _poll_inbox(bot, chat_id: int, info: dict | asyncpg.Record) -> None:
+    """Checks one inbox and sends the user a notice for each message not seen before."""
+    account_id = info["id"]
+    try:
+        # Only the Mail.tm fetch holds a poll slot; notifications (paced per chat) are sent after releasing it
+        async with _poll_semaphore, _poll_rate_limiter: # Bounds requests in flight and requests per second
+            messages = await fetch_inbox(chat_id, info)
+    except AccountGoneError:
+        await _forget_account(chat_id, account_id)
+        return
+    if messages is None:
+        return # Fetch failed; an empty baseline here would re-announce every existing message later
+    seen = _seen_messages.get(chat_id)
+    if seen is None or seen[0] != account_id:
+        # First look at this address (new account or bot restart): remember what's there without notifying
+        _seen_messages[chat_id] = (account_id, {msg["id"] for msg in messages if msg.get("id")})
+        return
+
+    for msg in messages:
+        if not await _notify_new_message(bot, chat_id, account_id, seen[1], msg):
             return
-        
-        account_id = current_email_info["id"]
-        token = current_email_info["token"]
-
-        message_content = await get_message_content(account_id, message_id, token)
-        if message_content:
-            subject = message_content.get('subject', 'No Subject')
-            from_address = message_content.get('from', {}).get('address', 'Unknown Sender')
-            text_body = message_content.get('text', message_content.get('html', 'No content available')).strip()
-            
-            # Simple HTML stripping if needed, for better display of HTML content
-            if '<html' in text_body.lower() and '<body' in text_body.lower():
-                from html.parser import HTMLParser
-                class HTMLStripper(HTMLParser):
-                    def __init__(self):
-                        super().__init__()
-                        self.reset()
-                        self.strict = False
-                        self.convert_charrefs= True
-                        self.text = []
-                    def handle_data(self, data):
-                        self.text.append(data)
-                    def get_data(self):
-                        return ''.join(self.text)
-                
-                stripper = HTMLStripper()
-                stripper.feed(text_body)
-                text_body = stripper.get_data()
-                text_body = " ".join(text_body.split()).strip() # Remove excessive whitespace
-
-            # Limit message length to avoid Telegram API limits
-            if len(text_body) > 4000:
-                text_body = text_body[:3900] + "\n\n... (Message truncated)"
-
-            await query.edit_message_text(
-                f"**Subject:** `{subject}`\n"
-                f"**From:** `{from_address}`\n\n"
-                f"**Content:**\n```\n{text_body}\n```",
-                parse_mode="Markdown"
+
+def _push_limiter(chat_id: int) -> AsyncLimiter:
+    """Returns the limiter pacing notifications to a chat, creating it if needed."""
+    limiter = _push_limiters.get(chat_id)
+    if limiter is None:
+        limiter = AsyncLimiter(PUSH_RATE_PER_CHAT, 1)
+        _push_limiters[chat_id] = limiter
+    return limiter
+
+async def _notify_new_message(bot, chat_id: int, account_id: str, seen_ids: set[str], msg: dict) -> bool:
+    """Tells the user about msg unless it was seen before; False if Telegram refused the send."""
+    msg_id = msg.get("id")
+    if not msg_id or msg_id in seen_ids:
+        return True
+    seen_ids.add(msg_id) # Marked before sending so a failed send is never retried every poll
+    subject = msg.get("subject") or "No Subject"
+    from_address = (msg.get("from") or {}).get("address") or "Unknown Sender" # Mail.tm may send null fields
+    try:
+        # Several mails arriving together are sent as a paced series instead of a burst Telegram throttles
+        async with _push_limiter(chat_id):
+            await bot.send_message(
+                chat_id,
+                f"New email received!\nFrom: {from_address}\nSubject: {subject}",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("View message", callback_data=f"view_msg_{msg_id}")]])
             )
-        else:
-            await query.edit_message_text("Could not retrieve message content. It might have expired or been deleted by Mail.tm.")
+    except Forbidden: # The user blocked the bot: stop polling and streaming for them
+        logger.info("chat_id %s blocked the bot, forgetting its address", chat_id)
+        await _forget_account(chat_id, account_id)
+        return False
+    except TelegramError as e:
+        logger.warning("Could not notify chat_id %s about a new message: %s", chat_id, e)
+        return False
+    return True
+
+async def _watch_account(bot, chat_id: int, account_id: str) -> None:
+    """Streams an account's Mercure events and pushes new messages the moment they arrive."""
+    delay = 1
+    while True:
+        try:
+            # Reread the row on every (re)connect: the token may have been renewed meanwhile
+            info = await get_user_email(chat_id)
+            if not info or info["id"] != account_id:
+                return # The chat moved on to another address (or deleted it)
+            async with mercure_session.get(MERCURE_URL, params={"topic": f"/accounts/{account_id}"}, headers=_auth(info["token"])) as response:
+                if response.status == 401: # Token rejected: renew it; raise_for_status below then schedules the reconnect
+                    await renew_token(chat_id, info)
+                if response.status in (403, 404): # Account gone, nothing left to watch
+                    logger.info("Mercure stream for chat_id %s closed: HTTP %s", chat_id, response.status)
+                    return
+                response.raise_for_status()
+                delay = 1
+                # Subscribed first, then a fresh listing records the baseline (first run) or catches up on
+                # anything missed while disconnected: mail landing in between is in the listing or an event
+                _inbox_cache.pop(account_id, None)
+                await _poll_inbox(bot, chat_id, info)
+                _pending_streams.discard(chat_id) # From here on, the poller covers the chat unless it is live
+                if _baseline(chat_id, account_id) is not None:
+                    _live_streams.add(chat_id) # Only now may the poller leave this chat to the stream
+                async for line in response.content:
+                    # Mail.tm sends each event as one "data: {json}" line; comments and blank lines are skipped
+                    if not line.startswith(b"data:"):
+                        continue
+                    try:
+                        event = orjson.loads(line[5:])
+                    except orjson.JSONDecodeError:
+                        continue
+                    if event.get("@type") != "Message":
+                        continue # Account updates (e.g. quota) are not interesting here
+                    _inbox_cache.pop(account_id, None) # The next /inbox must include the new message
+                    if _baseline(chat_id, account_id) is None:
+                        # The catch-up failed: take the baseline now, leaving this message out so it is still announced
+                        await _poll_inbox(bot, chat_id, info)
+                        seen_ids = _baseline(chat_id, account_id)
+                        if seen_ids is not None:
+                            seen_ids.discard(event.get("id"))
+                            _live_streams.add(chat_id)
+                    # Without any baseline the event is still new, so it is announced regardless
+                    seen_ids = _baseline(chat_id, account_id)
+                    await _notify_new_message(bot, chat_id, account_id, set() if seen_ids is None else seen_ids, event)
+        except AccountGoneError:
+            await _forget_account(chat_id, account_id)
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e: # ValueError: oversized line
+            logger.debug("Mercure stream for chat_id %s interrupted: %r", chat_id, e)
+        finally:
+            _live_streams.discard(chat_id)
+            _pending_streams.discard(chat_id)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
+def start_mail_watcher(bot, chat_id: int, account_id: str) -> None:
+    """Starts (or restarts, for a new account) the Mercure stream for a chat."""
+    stop_mail_watcher(chat_id)
+    if len(_mail_watchers) >= MERCURE_MAX_STREAMS:
+        # Watchers are kept in start order, so the oldest address falls back to the poller
+        stop_mail_watcher(next(iter(_mail_watchers)))
+    task = asyncio.create_task(_watch_account(bot, chat_id, account_id))
+    _mail_watchers[chat_id] = task
+    _pending_streams.add(chat_id) # Its own catch-up covers the chat until then
+    # Only forget the entry if it still points at this task (a newer watcher may have replaced it)
+    task.add_done_callback(lambda t: _mail_watchers.pop(chat_id, None) if _mail_watchers.get(chat_id) is t else None)
+
+def stop_mail_watcher(chat_id: int) -> None:
+    """Stops a chat's Mercure stream, if one is running."""
+    task = _mail_watchers.pop(chat_id, None)
+    if task:
+        task.cancel()
+    # A task cancelled before it ever ran never reaches its own cleanup
+    _live_streams.discard(chat_id)
+    _pending_streams.discard(chat_id)
+
+async def poll_all_inboxes(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodic job: checks recent inboxes without a Mercure stream and pushes new messages."""
+    rows = await db_pool.fetch(SQL_GET_POLLED_USER_EMAILS, float(INBOX_POLL_MAX_AGE))
+
+    # Forget chats whose address was deleted or aged out since the last run (unless a stream has them)
+    for chat_id in _seen_messages.keys() - {row["chat_id"] for row in rows} - _mail_watchers.keys():
+        del _seen_messages[chat_id]
+        _push_limiters.pop(chat_id, None)
+
+    # Streams already deliver (or are catching up on) their chats' mail; polling covers the newest of the rest
+    rows = [row for row in rows if row["chat_id"] not in _live_streams and row["chat_id"] not in _pending_streams]
+    rows = rows[:INBOX_POLL_MAX_CHATS]
+
+    results = await asyncio.gather(
+        *(_poll_inbox(context.bot, row["chat_id"], row) for row in rows),
+        return_exceptions=True
+    )
+    for row, result in zip(rows, results):
+        if isinstance(result, Exception):
+            logger.error("Inbox poll failed for chat_id %s: %r", row["chat_id"], result)
 
 # --- Application Lifecycle Hooks ---
 
 async def post_startup_init(application: Application):
-    """Initializes database pool after the bot starts."""
-    print("Running post_startup_init hook...")
-    await init_db_pool()
-    print("Bot fully initialized and connected to DB.")
+    """Initializes database pool and HTTP session after the bot starts."""
+    global http_session, mercure_session
+    logger.info("Running post_startup_init hook...")
+    # Keep-alive connection pool so repeated Mail.tm calls skip the TCP/TLS handshake
+    http_session = aiohttp.ClientSession(
+        base_url=MAILTM_API_URL,
+        connector=aiohttp.TCPConnector(limit=20, limit_per_host=10, keepalive_timeout=60, ttl_dns_cache=300),
+        json_serialize=lambda obj: orjson.dumps(obj).decode(), # aiohttp expects str, orjson returns bytes
+        timeout=aiohttp.ClientTimeout(total=10)
+    )
+    # One open stream per watched account (at most MERCURE_MAX_STREAMS), and no total timeout on a stream
+    mercure_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=MERCURE_MAX_STREAMS, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=MERCURE_IDLE_TIMEOUT)
+    )
+    # Warm the domain cache while the DB pool connects, so the first /generate skips that round trip
+    await asyncio.gather(init_db_pool(), get_domains())
+    # Resume streaming for the newest addresses (oldest started first, so it is evicted first);
+    # their catch-up fetches go through the poller's rate limit, so a restart doesn't burst Mail.tm
+    rows = await db_pool.fetch(SQL_GET_RECENT_USER_EMAILS, MERCURE_MAX_STREAMS)
+    for row in reversed(rows):
+        start_mail_watcher(application.bot, row["chat_id"], row["id"])
+    logger.info("Bot fully initialized and connected to DB.")
 
 
 async def pre_shutdown_cleanup(application: Application):
-    """Closes database pool before bot shuts down."""
-    global db_pool
+    """Stops mail watchers and closes database pool and HTTP sessions before bot shuts down."""
+    # Runs as post_stop: updates and jobs have stopped, but the bot is still initialized,
+    # so a watcher finishing a send here can't hit an already shut-down bot
+    watchers = list(_mail_watchers.values())
+    for task in watchers:
+        task.cancel()
+    await asyncio.gather(*watchers, return_exceptions=True)
+    if mercure_session:
+        await mercure_session.close()
+    if http_session:
+        await http_session.close()
+        logger.info("Mail.tm HTTP session closed during pre_shutdown_cleanup.")
     if db_pool:
         await db_pool.close()
-        print("PostgreSQL connection pool closed during pre_shutdown_cleanup.")
+        logger.info("PostgreSQL connection pool closed during pre_shutdown_cleanup.")
 
 
 # --- Main Bot Setup ---
 
 def main() -> None:
     """Starts the bot."""
+    log_listener = setup_logging()
+    try:
+        run_bot()
+    finally:
+        log_listener.stop() # Flushes any queued records
+
+def run_bot() -> None:
+    """Builds the application and runs it until shutdown."""
     if not TELEGRAM_BOT_TOKEN:
-        print("Error: TELEGRAM_BOT_TOKEN environment variable not set.")
-        print("Please set it before running the bot.")
+        logger.error("TELEGRAM_BOT_TOKEN environment variable not set.")
+        logger.error("Please set it before running the bot.")
         return
     
     # Check for DATABASE_URL as well
     if not os.getenv("DATABASE_URL"):
-        print("Error: DATABASE_URL environment variable not set.")
-        print("Please ensure PostgreSQL database is added and linked in Railway.")
+        logger.error("DATABASE_URL environment variable not set.")
+        logger.error("Please ensure PostgreSQL database is added and linked in Railway.")
         return
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Use the libuv-based event loop for faster socket I/O when installed (it isn't on Windows)
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not available, using the default asyncio event loop.")
+    else:
+        uvloop.install()
+
+    # Add post-startup and post-shutdown hooks
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True) # Handlers are bounded by limit_concurrency instead
+        # Paces every Bot API call under Telegram's flood limits (~30/s overall, 20/min per group)
+        # and retries once after a RetryAfter instead of failing the update
+        .rate_limiter(AIORateLimiter(max_retries=1))
+        .post_init(post_startup_init)
+        .post_stop(pre_shutdown_cleanup)
+        .build()
+    )
 
     # Register command handlers (ONLY ONCE)
     application.add_handler(CommandHandler("start", start))
@@ -480,12 +1203,28 @@ def main() -> None:
     # Register callback query handler for inline buttons (ONLY ONCE)
     application.add_handler(CallbackQueryHandler(handle_callback_query))
 
-    # Add post-startup and pre-shutdown hooks
-    application.post_init(post_startup_init)
-    application.pre_shutdown(pre_shutdown_cleanup)
+    # Push new mail to users without waiting for /inbox (requires the job-queue extra)
+    if application.job_queue:
+        application.job_queue.run_repeating(poll_all_inboxes, interval=INBOX_POLL_INTERVAL, first=5)
+    else:
+        logger.warning("JobQueue unavailable (install python-telegram-bot[job-queue]); new mail won't be pushed.")
+
+    # Only ask Telegram for the update types we handle (commands and button presses)
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
-    print("Bot setup complete. Starting polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if PUBLIC_URL:
+        # run_webhook registers the webhook with Telegram on startup and serves updates on PORT
+        logger.info("Bot setup complete. Starting webhook on port %s...", PORT)
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{PUBLIC_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            allowed_updates=allowed_updates
+        )
+    else:
+        logger.info("Bot setup complete. Starting polling...")
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == "__main__":
     main()